@@ -1,6 +1,448 @@
 # src/utils.py
 
+import functools
+import os
+import random
+from collections import Counter, deque
+
+import matplotlib
+
+# En ejecuciones sin pantalla (p. ej. entrenamientos en servidor) se puede
+# forzar el backend Agg antes de importar pyplot
+if os.environ.get("BLACKJACK_HEADLESS"):
+    matplotlib.use("Agg", force=True)
+
+import matplotlib.pyplot as plt
 import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import PatchCollection
+from matplotlib.figure import Figure
+from matplotlib.patches import PathPatch, Rectangle
+from matplotlib.textpath import TextPath
+from matplotlib.transforms import Affine2D
+
+# Dimensiones de las cartas dibujadas sobre el tapete (coordenadas de eje)
+CARD_WIDTH = 0.12
+CARD_HEIGHT = 0.18
+
+# Patrón del reverso de las cartas ocultas: rejilla de puntos rojo oscuro
+# (#8B0000 con alpha 0.5) precalculada una sola vez como imagen RGBA.
+# Dibujarla con un único imshow evita añadir 50 Rectangle por carta oculta.
+_pattern = np.zeros((20, 10, 4))
+_pattern[::2, ::2] = (0.545, 0.0, 0.0, 0.5)
+HIDDEN_PATTERN = _pattern
+
+# Tablas de símbolos: indexar una tupla evita la cadena de if/elif por carta
+_CARD_STR = ("", "A", "2", "3", "4", "5", "6", "7", "8", "9",
+             "10", "J", "Q", "K")
+_TEN_SYMBOLS = ("10", "J", "Q", "K")
+_TEN_SYMBOL_SET = frozenset(_TEN_SYMBOLS)
+
+# Símbolos dibujados en rojo sobre la carta
+_RED_SYMBOLS = frozenset({"A", "J", "Q", "K", "10"})
+
+# Glifos de los símbolos de carta preconstruidos como TextPath centrados en
+# el origen: el trazado de fuentes se hace una vez por símbolo y tamaño en
+# lugar de en cada Text dibujado por frame
+_GLYPH_SIZES = (10, 18)
+_GLYPH_PATHS = {}
+for _sym in _CARD_STR[1:]:
+    for _size in _GLYPH_SIZES:
+        _path = TextPath((0, 0), _sym, size=_size)
+        _bbox = _path.get_extents()
+        _GLYPH_PATHS[(_sym, _size)] = _path.transformed(
+            Affine2D().translate(-(_bbox.x0 + _bbox.x1) / 2,
+                                 -(_bbox.y0 + _bbox.y1) / 2))
+
+# Escala de puntos a coordenadas de eje para la figura de 5x6 pulgadas con
+# la disposición fija (0.96 del ancho y 0.90 del alto útiles)
+_PT_TO_X = 1.0 / (5 * 0.96 * 72)
+_PT_TO_Y = 1.0 / (6 * 0.90 * 72)
+
+# Parejas iniciales válidas por suma del jugador, precalculadas para todo
+# el dominio de sumas posible: evita reconstruir la lista en cada reparto
+_VALID_PAIRS = {s: tuple((a, s - a) for a in range(2, 11)
+                         if 2 <= s - a <= 10)
+                for s in range(4, 22)}
+
+# Posiciones de las cartas precalculadas por número de cartas: para manos
+# tan pequeñas las listas de Python ganan a crear arrays de NumPy por frame
+_X_POSITIONS = {n: [0.2 + (0.6 * i / (n - 1) if n > 1 else 0.3)
+                    for i in range(n)]
+                for n in range(13)}
+_TWO_ROW_POSITIONS = {
+    n: (_X_POSITIONS[(n + 1) // 2] + _X_POSITIONS[n - (n + 1) // 2],
+        [0.38] * ((n + 1) // 2) + [0.22] * (n - (n + 1) // 2))
+    for n in range(4, 13)
+}
+
+# Estado global de la visualización: historial de cartas del jugador y
+# símbolo elegido para las cartas de valor 10 (para mantener consistencia
+# visual dentro de un mismo episodio). El historial está acotado para no
+# crecer sin límite si no se llama a reset_globals en bucles largos, y un
+# contador mantiene en O(1) la consulta de símbolos de valor 10 presentes
+player_cards_history = deque(maxlen=12)
+_ten_symbol_counts = Counter()
+TEN_VALUE_SYMBOL = None
+
+# Totales del crupier memoizados por composición canónica de la mano
+# (tupla ordenada): manos con las mismas cartas en distinto orden
+# comparten entrada y evitan repetir la reducción y el ajuste de ases
+_DEALER_STATE_CACHE = {}
+
+# Paso de muestreo de frames: con BLACKJACK_VIZ_STRIDE=N solo se dibuja
+# una de cada N llamadas a visualize_blackjack_step (el resto devuelve
+# None sin tocar matplotlib, aunque el historial sí se actualiza)
+_VIZ_STRIDE = int(os.environ.get("BLACKJACK_VIZ_STRIDE", "1"))
+_call_counter = 0
+
+# Figura y eje persistentes para el renderizado de frames: crear un
+# Figure/Canvas/Renderer por frame domina el coste al generar rollouts
+_FIG = None
+_AX = None
+
+
+def reset_globals():
+    """Reinicia el estado global de la visualización entre episodios."""
+    global TEN_VALUE_SYMBOL
+    player_cards_history.clear()
+    _ten_symbol_counts.clear()
+    TEN_VALUE_SYMBOL = None
+    _render_state.cache_clear()
+
+
+def _record_cards(cards):
+    """Añade cartas al historial manteniendo el contador de valores 10."""
+    for card in cards:
+        if len(player_cards_history) == player_cards_history.maxlen:
+            # El deque va a descartar la carta más antigua
+            dropped = player_cards_history[0]
+            if dropped in _TEN_SYMBOL_SET:
+                _ten_symbol_counts[dropped] -= 1
+        player_cards_history.append(card)
+        if card in _TEN_SYMBOL_SET:
+            _ten_symbol_counts[card] += 1
+
+
+def _ten_symbol():
+    """Devuelve el símbolo compartido por las cartas de valor 10."""
+    global TEN_VALUE_SYMBOL
+    if TEN_VALUE_SYMBOL is None:
+        TEN_VALUE_SYMBOL = _TEN_SYMBOLS[random.randrange(4)]
+    return TEN_VALUE_SYMBOL
+
+
+def card_value_to_str(value):
+    """Convierte el valor numérico de una carta (1-10) en su símbolo."""
+    if value == 10:
+        # Todas las cartas de valor 10 sin identificar usan el mismo símbolo
+        return _ten_symbol()
+    return _CARD_STR[value]
+
+
+def _value_from_diff(old_sum, new_sum, old_usable_ace, new_usable_ace):
+    """Núcleo entero: valor de la carta implícito en el cambio de suma."""
+    if old_usable_ace and not new_usable_ace:
+        # El as ha pasado de valer 11 a valer 1
+        return new_sum - old_sum + 10
+    return new_sum - old_sum
+
+
+def determine_new_card(old_sum, new_sum, old_usable_ace, new_usable_ace):
+    """
+    Deduce la carta recibida tras un hit a partir del cambio en la suma
+    del jugador y en el estado del as usable.
+    """
+    card_value = _value_from_diff(old_sum, new_sum,
+                                  old_usable_ace, new_usable_ace)
+    if card_value == 1:
+        return "A"
+    elif card_value >= 10:
+        # Reutiliza un símbolo de valor 10 ya presente en la mano si lo hay
+        existing_10s = [s for s, c in _ten_symbol_counts.items() if c > 0]
+        if len(existing_10s) == 1:
+            return existing_10s[0]
+        if existing_10s:
+            return existing_10s[random.randrange(len(existing_10s))]
+        return _TEN_SYMBOLS[random.randrange(4)]
+    else:
+        return str(card_value)
+
+
+def _choose_pair(player_sum):
+    """Núcleo entero: elige una pareja (a, b) de cartas que suman lo dado."""
+    valid_pairs = _VALID_PAIRS.get(player_sum, ())
+    if not valid_pairs:
+        raise ValueError(f"No hay pareja inicial válida para la suma {player_sum}")
+    return valid_pairs[random.randrange(len(valid_pairs))]
+
+
+def generate_initial_player_cards(player_sum, usable_ace=False):
+    """Genera dos cartas iniciales compatibles con la suma del jugador."""
+    if usable_ace:
+        # Un as contado como 11 más otra carta
+        return ["A", card_value_to_str(player_sum - 11)]
+
+    a, b = _choose_pair(player_sum)
+    return [card_value_to_str(a), card_value_to_str(b)]
+
+
+def _card_geom(x, y, card_value, hidden=False, highlight=False):
+    """
+    Calcula la geometría de una carta sin tocar el eje: devuelve su
+    rectángulo y la lista de textos (x, y, rotación, tamaño, texto, color).
+    """
+    half_w = CARD_WIDTH / 2
+    half_h = CARD_HEIGHT / 2
+    edge_color = "gold" if highlight else "black"
+    line_width = 3 if highlight else 1.5
+    rect = Rectangle((x - half_w, y - half_h), CARD_WIDTH, CARD_HEIGHT,
+                     facecolor="white", edgecolor=edge_color,
+                     linewidth=line_width, zorder=2)
+    if hidden:
+        return rect, []
+
+    margin_x = half_w - CARD_WIDTH * 0.2
+    margin_y = half_h - CARD_HEIGHT * 0.15
+    color = "red" if card_value in _RED_SYMBOLS else "black"
+    # Esquina superior izquierda, esquina inferior derecha (girada) y centro
+    texts = [
+        (x - margin_x, y + margin_y, 0, 10, card_value, color),
+        (x + margin_x, y - margin_y, 180, 10, card_value, color),
+        (x, y, 0, 18, card_value, color),
+    ]
+    return rect, texts
+
+
+def _flush_cards(ax, rects, texts):
+    """Añade todas las cartas acumuladas al eje en una única colección."""
+    if rects:
+        ax.add_collection(PatchCollection(rects, match_original=True,
+                                          zorder=2))
+    for tx, ty, rotation, size, text, color in texts:
+        glyph = _GLYPH_PATHS.get((text, size))
+        if glyph is None:
+            continue
+        # Rotación en espacio de puntos (solo 0/180°), escala a coordenadas
+        # de eje y traslación al centro de la carta
+        transform = (Affine2D().rotate_deg(rotation)
+                     .scale(_PT_TO_X, _PT_TO_Y).translate(tx, ty))
+        ax.add_patch(PathPatch(glyph.transformed(transform),
+                               facecolor=color, edgecolor="none", zorder=3))
+
+
+def _draw_hidden_pattern(ax, x, y):
+    """Estampa el patrón del reverso sobre la carta oculta en (x, y)."""
+    # aspect="auto" evita que imshow cambie el aspecto del eje (y con él
+    # la geometría de todos los frames posteriores del eje persistente)
+    ax.imshow(HIDDEN_PATTERN,
+              extent=(x - CARD_WIDTH / 2, x + CARD_WIDTH / 2,
+                      y - CARD_HEIGHT / 2, y + CARD_HEIGHT / 2),
+              interpolation="nearest", zorder=2.1, aspect="auto")
+
+
+def draw_card(ax, x, y, card_value, hidden=False, highlight=False):
+    """Dibuja una única carta en la posición (x, y) del eje dado."""
+    rect, texts = _card_geom(x, y, card_value, hidden=hidden,
+                             highlight=highlight)
+    _flush_cards(ax, [rect], texts)
+    if hidden:
+        _draw_hidden_pattern(ax, x, y)
+
+
+def _build_fig(player_sum, dealer_card, usable_ace, player_cards_history,
+               dealer_cards=None, new_card=None):
+    """
+    Dibuja las dos manos sobre el tapete reutilizando una figura
+    persistente: solo se limpia y repuebla el eje en cada llamada.
+    """
+    global _FIG, _AX
+    if _FIG is None:
+        # Figure + FigureCanvasAgg directamente, sin pasar por el gestor
+        # de figuras de pyplot (este renderizado es siempre offscreen)
+        _FIG = Figure(figsize=(5, 6))
+        FigureCanvasAgg(_FIG)
+        _AX = _FIG.add_subplot(111)
+        _FIG.suptitle("Blackjack", fontsize=16)
+        # Disposición fija: evita el caro cálculo de tight_layout por frame
+        _FIG.subplots_adjust(left=0.02, right=0.98, top=0.92, bottom=0.02)
+    else:
+        _AX.clear()
+    fig, ax = _FIG, _AX
+    ax.set_xlim(0, 1)
+    ax.set_ylim(0, 1)
+    ax.axis("off")
+
+    # Tapete verde de fondo
+    ax.add_patch(Rectangle((0, 0), 1, 1, facecolor="darkgreen", zorder=0))
+
+    # Geometría acumulada de todas las cartas; se vuelca al eje en una
+    # única colección al final en lugar de un add_patch por carta
+    rects = []
+    texts = []
+
+    # --- Mano del crupier ---
+    if dealer_cards is None:
+        # Solo se conoce la carta descubierta
+        rect, card_texts = _card_geom(0.4, 0.75, card_value_to_str(dealer_card))
+        rects.append(rect)
+        texts.extend(card_texts)
+        rect, _ = _card_geom(0.6, 0.75, "", hidden=True)
+        rects.append(rect)
+        _draw_hidden_pattern(ax, 0.6, 0.75)
+        dealer_text = f"Crupier: {'A' if dealer_card == 1 else dealer_card}"
+    else:
+        dealer_key = tuple(sorted(dealer_cards, reverse=True))
+        dealer_total = _DEALER_STATE_CACHE.get(dealer_key)
+        if dealer_total is None:
+            # Reducción vectorizada: una sola pasada en C sobre la mano
+            arr = np.asarray(dealer_cards)
+            vals = np.where(arr == 1, 11, np.minimum(arr, 10))
+            dealer_total = int(vals.sum())
+            num_aces = int((arr == 1).sum())
+            # Ajuste de ases en forma cerrada: cada as que pasa de 11 a 1
+            # resta exactamente 10, tantas veces como haga falta y sea posible
+            excess = max(0, dealer_total - 21)
+            dealer_total -= 10 * min(num_aces, (excess + 9) // 10)
+            _DEALER_STATE_CACHE[dealer_key] = dealer_total
+        for x, c in zip(_X_POSITIONS[len(dealer_cards)], dealer_cards):
+            rect, card_texts = _card_geom(x, 0.75, card_value_to_str(c))
+            rects.append(rect)
+            texts.extend(card_texts)
+        dealer_text = f"Crupier: {dealer_total}"
+    ax.text(0.5, 0.92, dealer_text, fontsize=14, color="white",
+            ha="center", va="center", weight="bold")
+
+    # --- Mano del jugador ---
+    num_cards = len(player_cards_history)
+    if num_cards <= 3:
+        x_positions = _X_POSITIONS[num_cards]
+        y_positions = [0.30] * num_cards
+    else:
+        # Dos filas cuando la mano no cabe en una sola
+        x_positions, y_positions = _TWO_ROW_POSITIONS[num_cards]
+
+    last_idx = num_cards - 1
+    has_new = new_card is not None
+    for idx, card in enumerate(player_cards_history):
+        highlight = has_new and idx == last_idx
+        rect, card_texts = _card_geom(x_positions[idx], y_positions[idx],
+                                      card, highlight=highlight)
+        rects.append(rect)
+        texts.extend(card_texts)
+
+    _flush_cards(ax, rects, texts)
+
+    ace_text = " (as usable)" if usable_ace else ""
+    ax.text(0.5, 0.08, f"Jugador: {player_sum}{ace_text}", fontsize=14,
+            color="white", ha="center", va="center", weight="bold")
+
+    return fig
+
+
+def _state_key(player_sum, dealer_card, usable_ace, player_cards,
+               dealer_cards, new_card):
+    """Construye la clave hashable que identifica un estado a renderizar."""
+    return (player_sum, dealer_card, usable_ace, tuple(player_cards),
+            None if dealer_cards is None else tuple(dealer_cards), new_card)
+
+
+@functools.lru_cache(maxsize=2048)
+def _render_state(state_key):
+    """
+    Renderiza el estado dado y devuelve su buffer RGBA uint8 de forma
+    (alto, ancho, 4). Los estados se repiten constantemente durante los
+    rollouts, por lo que el resultado se memoiza por clave de estado; el
+    array devuelto es de solo lectura por estar compartido entre llamadas.
+    """
+    (player_sum, dealer_card, usable_ace,
+     player_cards, dealer_cards, new_card) = state_key
+    fig = _build_fig(player_sum, dealer_card, usable_ace, list(player_cards),
+                     dealer_cards=None if dealer_cards is None else list(dealer_cards),
+                     new_card=new_card)
+    fig.canvas.draw()
+    buf = np.asarray(fig.canvas.buffer_rgba()).copy()
+    buf.setflags(write=False)
+    return buf
+
+
+def create_card_visualization(player_sum, dealer_card, usable_ace,
+                              player_cards_history, dealer_cards=None,
+                              new_card=None):
+    """
+    Crea una figura con la mano del jugador y la del crupier sobre un
+    tapete verde. Si `dealer_cards` es None solo se muestra la carta
+    descubierta del crupier junto a una carta oculta.
+
+    Las figuras de matplotlib no se pueden compartir con seguridad, así
+    que se memoiza el buffer RGBA renderizado y se devuelve una figura
+    ligera que solo contiene ese buffer.
+    """
+    buf = _render_state(_state_key(player_sum, dealer_card, usable_ace,
+                                   player_cards_history, dealer_cards,
+                                   new_card))
+
+    fig, ax = plt.subplots(figsize=(5, 6))
+    ax.imshow(buf)
+    ax.axis("off")
+    return fig
+
+
+def _advance_step_state(obs, action, new_obs):
+    """
+    Actualiza el historial global de cartas para un paso del episodio y
+    devuelve el estado (suma, carta del crupier, as usable, carta nueva)
+    que corresponde dibujar.
+    """
+    player_sum, dealer_card, usable_ace = obs
+
+    if not player_cards_history:
+        _record_cards(generate_initial_player_cards(player_sum, usable_ace))
+
+    new_card = None
+    if action == 1 and new_obs is not None:
+        # Hit: deduce la carta recibida y actualiza el historial
+        new_sum, _, new_usable_ace = new_obs
+        new_card = determine_new_card(player_sum, new_sum,
+                                      usable_ace, new_usable_ace)
+        _record_cards((new_card,))
+        player_sum, usable_ace = new_sum, new_usable_ace
+
+    return player_sum, dealer_card, usable_ace, new_card
+
+
+def visualize_blackjack_step(obs, action, new_obs=None, dealer_cards=None):
+    """
+    Visualiza un paso de un episodio de Blackjack. Mantiene el historial
+    de cartas del jugador entre llamadas (usar `reset_globals` al empezar
+    un episodio nuevo). Si BLACKJACK_VIZ_STRIDE indica saltarse este
+    frame, devuelve None tras actualizar el historial.
+    """
+    global _call_counter
+    _call_counter += 1
+    player_sum, dealer_card, usable_ace, new_card = \
+        _advance_step_state(obs, action, new_obs)
+    if _VIZ_STRIDE > 1 and _call_counter % _VIZ_STRIDE != 0:
+        # No se va a mostrar: mantiene el estado pero no dibuja nada
+        return None
+    return create_card_visualization(player_sum, dealer_card, usable_ace,
+                                     player_cards_history,
+                                     dealer_cards=dealer_cards,
+                                     new_card=new_card)
+
+
+def render_blackjack_step(obs, action, new_obs=None, dealer_cards=None):
+    """
+    Variante de `visualize_blackjack_step` que devuelve directamente el
+    buffer RGBA uint8 (alto, ancho, 4) del frame, sin construir una
+    figura: pensada para quien solo necesita píxeles (guardar a disco,
+    componer un GIF/vídeo...). El array devuelto es de solo lectura.
+    """
+    player_sum, dealer_card, usable_ace, new_card = \
+        _advance_step_state(obs, action, new_obs)
+    return _render_state(_state_key(player_sum, dealer_card, usable_ace,
+                                    player_cards_history, dealer_cards,
+                                    new_card))
 
 
 def run_and_render_episode(env, policy_fn, max_steps=1000):